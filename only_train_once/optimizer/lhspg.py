@@ -1,5 +1,6 @@
 import torch
 import numpy as np
+from typing import Optional
 from torch.optim.optimizer import Optimizer, required
 import torch.nn.functional as F
 
@@ -9,6 +10,41 @@ from only_train_once.transform import tensor_transformation, TensorTransform
 
 LORA_NAMES = [('lora_B', 'lora_A'), ('lora_embedding_B', 'lora_embedding_A')]
 
+def refine_num_active_redundant_groups(num_groups, group_divisible, num_important_groups, num_active_redundant_groups, num_pruned_groups):
+    # Return the refined number of active redundant groups which keeps the important groups divisible by group_divisible,
+    # or None if the trial number of important groups is already divisible.
+    trial_num_important_groups = num_important_groups - num_active_redundant_groups
+    if trial_num_important_groups % group_divisible == 0 and trial_num_important_groups > 0:
+        return None
+    ratio = trial_num_important_groups // group_divisible + 1 # Add one will preserve more groups, otherwise will slim more.
+    if ratio <= 1 or trial_num_important_groups == 0:
+        refined_num_important_groups = max(int(group_divisible), 1)
+    else:
+        refined_num_important_groups = max(int(ratio * group_divisible), int(group_divisible))
+    refined_num_important_groups = min(num_groups, refined_num_important_groups)
+    return num_groups - num_pruned_groups - refined_num_important_groups
+
+def gradient_descent_step_(params, grads, lr, weight_decay=None):
+    # Apply the decoupled weight decay (if any) and the descent step over a list of tensors via multi-tensor kernels
+    if len(params) == 0:
+        return
+    if weight_decay is not None:
+        # p - lr * wd * p == p * (1 - lr * wd), a single scalar multiply without temporaries
+        torch._foreach_mul_(params, 1.0 - lr * weight_decay)
+    torch._foreach_add_(params, grads, alpha=-lr)
+
+@torch.jit.script
+def scale_selected_slices_(tensor: torch.Tensor, idxes: torch.Tensor, scale: float, dim: int = 0):
+    # Only read and write the selected slices along dim, the rest of the tensor is left untouched
+    tensor.index_copy_(dim, idxes, tensor.index_select(dim, idxes) * scale)
+
+@torch.jit.script
+def decay_triplet_(p: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor], idxes: torch.Tensor, scale: float):
+    scale_selected_slices_(p, idxes, scale, 0)
+    scale_selected_slices_(weight, idxes, scale, 0)
+    if bias is not None:
+        scale_selected_slices_(bias, idxes, scale, 0)
+
 class LHSPG(Optimizer):
     def __init__(self, params, variant='sgd', lr=required, epsilon=0.0, save_memory=True, device=None, \
                  first_momentum=None, second_momentum=None, dampening=None, weight_decay=None, target_group_sparsity=0.5, \
@@ -49,7 +85,7 @@ class LHSPG(Optimizer):
         self.num_redundant_groups = 0 # number of redundant groups
 
         self.pruned_group_idx = list()
-        self.pruned_group_idx_by_cluster = dict()
+        self.pruned_mask_by_cluster = dict()
 
         self.importance_score_criteria = importance_score_criteria
 
@@ -60,8 +96,9 @@ class LHSPG(Optimizer):
         super(LHSPG, self).__init__(params, defaults)
 
         self.group_divisible = group_divisible
-        self.first_moment_grads = dict()
-        self.second_moment_grads = dict()
+        # Momentum buffers laid out as [group_idx][param_idx] so that each group can be updated in one foreach call
+        self.first_moment_grads = [[None] * len(param_group['params']) for param_group in self.param_groups]
+        self.second_moment_grads = [[None] * len(param_group['params']) for param_group in self.param_groups]
 
         # Set up total number of prunable groups
         self.total_num_groups = 0
@@ -94,6 +131,28 @@ class LHSPG(Optimizer):
 
         print(self.total_num_groups, self.total_num_groups_by_clusters)
 
+        # Assign cluster-wise global indexes once, along with lookup tables routing them back to (group, local index)
+        self.gidx_to_group_by_cluster = dict()
+        self.gidx_to_local_by_cluster = dict()
+        for cluster_name in self.prunable_param_group_clusters:
+            param_group_cluster = self.prunable_param_group_clusters[cluster_name]
+            global_start_idx = 0
+            for param_group in param_group_cluster:
+                if param_group['is_auxiliary']:
+                    continue
+                param_group['global_start_idx'] = global_start_idx
+                global_start_idx += param_group['num_groups']
+            gidx_to_group = torch.empty(global_start_idx, dtype=torch.long)
+            gidx_to_local = torch.empty(global_start_idx, dtype=torch.long)
+            for k, param_group in enumerate(param_group_cluster):
+                if param_group['is_auxiliary']:
+                    continue
+                start_idx = param_group['global_start_idx']
+                gidx_to_group[start_idx:start_idx+param_group['num_groups']] = k
+                gidx_to_local[start_idx:start_idx+param_group['num_groups']] = torch.arange(param_group['num_groups'])
+            self.gidx_to_group_by_cluster[cluster_name] = gidx_to_group
+            self.gidx_to_local_by_cluster[cluster_name] = gidx_to_local
+
         # Set up target number of redundant groups
         self.target_num_redundant_groups = 0
         self.target_num_redundant_groups_by_clusters = dict()
@@ -111,7 +170,6 @@ class LHSPG(Optimizer):
         self.active_num_redundant_groups_by_clusters = dict()
         for cluster_name in self.prunable_param_group_clusters:
             self.active_num_redundant_groups_by_clusters[cluster_name] = dict()
-            self.pruned_group_idx_by_cluster[cluster_name] = list()
             
         for cluster_name in self.prunable_param_group_clusters:
             param_group_cluster = self.prunable_param_group_clusters[cluster_name]
@@ -123,16 +181,29 @@ class LHSPG(Optimizer):
                     self.active_num_redundant_groups_by_clusters[cluster_name][p] = self.target_num_redundant_groups_by_clusters[cluster_name] // self.pruning_periods
                     groups_sum += self.active_num_redundant_groups_by_clusters[cluster_name][p]
 
-        self.important_idxes = dict()
+        # Pruned indexes are kept as device long tensors derived from the boolean pruned masks, while important
+        # groups are only tracked as boolean masks
+        self.important_masks = dict()
         self.pruned_idxes = dict()
+        self.pruned_masks = dict()
         self.active_redundant_idxes = dict()
+        self.expanded_pruned_idxes = dict() # Cached device index tensors of pruned_idxes expanded by p_transform
+        self.expanded_active_redundant_idxes = dict()
         
         for param_group in params:
-            self.important_idxes[param_group['id']] = [i for i in range(param_group['num_groups'])]
-            self.pruned_idxes[param_group['id']] = list()
+            device = self.device if self.device is not None else param_group['params'][0].device
+            self.important_masks[param_group['id']] = torch.ones(param_group['num_groups'], dtype=torch.bool, device=device)
+            self.pruned_idxes[param_group['id']] = torch.zeros(0, dtype=torch.long, device=device)
+            self.pruned_masks[param_group['id']] = torch.zeros(param_group['num_groups'], dtype=torch.bool, device=device)
+            self.expanded_pruned_idxes[param_group['id']] = dict()
             self.active_redundant_idxes[param_group['id']] = list()
+            # Device index tensor of the active redundant groups
+            param_group['active_redundant_idxes'] = torch.zeros(0, dtype=torch.long, device=device)
+            # Active redundant indexes expanded by the p_transform of each lora_B param
+            self.expanded_active_redundant_idxes[param_group['id']] = dict()
 
         self.curr_group_sparsity, _, self.curr_num_zero_groups = self.compute_group_sparsity_param_norm()
+        self.sparsity_dirty = True # Whether the group sparsity needs to be recomputed at the end of step
 
         print(self.active_num_redundant_groups_by_clusters)
         print(self.curr_group_sparsity, _, self.curr_num_zero_groups)
@@ -142,34 +213,74 @@ class LHSPG(Optimizer):
         for param_group in self.param_groups:
             for (p_name, param) in zip(param_group['p_names'], param_group['params']):
                 self.named_parameters[p_name] = param
+
+        # Resolve the lora_B / lora_embedding_B params of prunable groups along with their original weights once,
+        # so that step() does not need to parse param names and look them up repeatedly
+        self.lora_B_meta = dict()
+        self.lora_embedding_B_meta = dict()
+        self.decay_params = dict()
+        for param_group in self.param_groups:
+            if not param_group['is_prunable'] or param_group['is_auxiliary']:
+                continue
+            lora_B_meta = list()
+            lora_embedding_B_meta = list()
+            decay_params = list()
+            for (p_name, param, p_transform) in zip(param_group['p_names'], param_group['params'], param_group['p_transform']):
+                if 'lora_B' in p_name:
+                    original_weight = self.named_parameters[p_name.split('lora_B')[0] + 'weight']
+                    original_bias = self.named_parameters.get(p_name.split('lora_B')[0] + 'bias', None)
+                    is_transpose = p_transform == TensorTransform.TRANSPOSE and len(param.data.shape) > 1
+                    lora_B_meta.append((p_name, param, original_weight, original_bias, p_transform, is_transpose))
+                if 'lora_embedding_B' in p_name:
+                    original_weight = self.named_parameters[p_name.split('lora_embedding_B')[0] + 'weight']
+                    lora_embedding_B_meta.append((p_name, param, original_weight))
+                if p_transform == TensorTransform.BASIC:
+                    decay_params.append((param, 0))
+                elif p_transform == TensorTransform.TRANSPOSE:
+                    decay_params.append((param, 1))
+            self.lora_B_meta[param_group['id']] = lora_B_meta
+            self.lora_embedding_B_meta[param_group['id']] = lora_embedding_B_meta
+            self.decay_params[param_group['id']] = decay_params
         
     def __setstate__(self, state):
         super(LHSPG, self).__setstate__(state)
 
-    def get_first_momentum_grad(self, name, first_moment, dampening, grad):
+    def get_first_momentum_grad(self, i, p_idxes, first_moment, dampening, grads):
         if first_moment > 0:
-            if name not in self.first_moment_grads:
-                buf = self.first_moment_grads[name] = grad
-            else:
-                buf = self.first_moment_grads[name]
-                buf.mul_(first_moment).add_(grad, alpha=(1.0-dampening))
-            return buf
+            group_bufs = self.first_moment_grads[i]
+            stale_bufs, stale_grads = list(), list()
+            for j, grad in zip(p_idxes, grads):
+                if group_bufs[j] is None:
+                    group_bufs[j] = grad
+                else:
+                    stale_bufs.append(group_bufs[j])
+                    stale_grads.append(grad)
+            # Update all existing buffers of the group via multi-tensor kernels
+            if len(stale_bufs) > 0:
+                torch._foreach_mul_(stale_bufs, first_moment)
+                torch._foreach_add_(stale_bufs, stale_grads, alpha=(1.0-dampening))
+            return [group_bufs[j] for j in p_idxes]
         else:
-            return grad
+            return grads
 
-    def get_second_momentum_grad_square(self, name, second_moment, dampening, grad):
+    def get_second_momentum_grad_square(self, i, p_idxes, second_moment, dampening, grads):
         if second_moment > 0:
-            if name not in self.second_moment_grads:
-                buf = self.second_moment_grads[name] = grad * grad
-            else:
-                buf = self.second_moment_grads[name]
-                buf.mul_(second_moment).add_(grad * grad, alpha=(1.0-dampening))
-            return buf
+            group_bufs = self.second_moment_grads[i]
+            stale_bufs, stale_grads = list(), list()
+            for j, grad in zip(p_idxes, grads):
+                if group_bufs[j] is None:
+                    group_bufs[j] = grad * grad
+                else:
+                    stale_bufs.append(group_bufs[j])
+                    stale_grads.append(grad)
+            if len(stale_bufs) > 0:
+                torch._foreach_mul_(stale_bufs, second_moment)
+                torch._foreach_addcmul_(stale_bufs, stale_grads, stale_grads, value=(1.0-dampening))
+            return [group_bufs[j] for j in p_idxes]
         else:
-            return grad * grad
+            return torch._foreach_mul(grads, grads)
 
     def compute_importance_scores(self):
-        global_start_idx = 0
         self.global_scores = list() # Accumulate global scores
         # Calculate raw importance scores by varying criteria
         for group in self.param_groups:
@@ -179,17 +290,27 @@ class LHSPG(Optimizer):
         # Normalize importance_score
         # Calculate normalization_denoms
         normalization_denoms = dict.fromkeys(self.importance_score_criteria.keys(), self.safe_guard)
+        partial_sq_sums = {proxy_name: list() for proxy_name in self.importance_score_criteria}
         for group in self.param_groups:
             if group['is_prunable'] and not group['is_auxiliary']:
                 for proxy_name in self.importance_score_criteria:
-                    normalization_denoms[proxy_name] += torch.sum(group['importance_scores'][proxy_name] ** 2, dim=0).item()
+                    if not proxy_name in group['importance_scores']:
+                        continue
+                    # Accumulate in float64, half-precision scores would overflow once summed across all groups
+                    score = group['importance_scores'][proxy_name].view(-1).double()
+                    partial_sq_sums[proxy_name].append(torch.dot(score, score))
+        # Fetch the squared norms of all proxies with a single host sync
+        proxy_names = [proxy_name for proxy_name in partial_sq_sums if len(partial_sq_sums[proxy_name]) > 0]
+        if len(proxy_names) > 0:
+            sq_sums = torch.stack([torch.stack(partial_sq_sums[proxy_name]).sum() for proxy_name in proxy_names]).cpu().tolist()
+            for proxy_name, sq_sum in zip(proxy_names, sq_sums):
+                normalization_denoms[proxy_name] += sq_sum
         for proxy_name in normalization_denoms:
             normalization_denoms[proxy_name] = np.sqrt(normalization_denoms[proxy_name]) + self.safe_guard
 
         self.cluster_importance_scores = dict()
         for cluster_name in self.prunable_param_group_clusters:
             param_group_cluster = self.prunable_param_group_clusters[cluster_name]
-            global_start_idx = 0
             cluster_importance_score = list()
             for group in param_group_cluster:
                 if group['is_prunable'] and not group['is_auxiliary']:
@@ -202,10 +323,6 @@ class LHSPG(Optimizer):
                             group['importance_scores']['overall'] = group['importance_scores'][proxy_name].clone()
                         else:
                             group['importance_scores']['overall'] += group['importance_scores'][proxy_name]              
-                    
-                    group['global_start_idx'] = global_start_idx
-                    group['global_idxes'] = np.arange(global_start_idx, global_start_idx+group['num_groups'])
-                    global_start_idx += group['num_groups']
                     cluster_importance_score.append(group['importance_scores']['overall'])
             self.cluster_importance_scores[cluster_name] = cluster_importance_score
 
@@ -216,38 +333,65 @@ class LHSPG(Optimizer):
             cluster_importance_score = torch.cat(self.cluster_importance_scores[cluster_name], dim=0)
             active_num_redundant_groups = self.active_num_redundant_groups_by_clusters[cluster_name][self.curr_pruning_period]
 
-            # Pick up the groups with the least K importance scores
-            curr_K = len(self.pruned_group_idx_by_cluster[cluster_name]) + active_num_redundant_groups
-            _, top_indices = torch.topk(-cluster_importance_score, curr_K)
-            top_indices = top_indices.cpu().numpy()
-            top_indices = np.setdiff1d(top_indices, self.pruned_group_idx_by_cluster[cluster_name])[:active_num_redundant_groups].tolist()
-            self.pruned_group_idx_by_cluster[cluster_name].extend(top_indices)
-            
-            for group in self.prunable_param_group_clusters[cluster_name]:
+            # Pick up the groups with the least K importance scores, excluding the ones already picked in previous periods
+            if cluster_name not in self.pruned_mask_by_cluster:
+                self.pruned_mask_by_cluster[cluster_name] = torch.zeros_like(cluster_importance_score, dtype=torch.bool)
+            pruned_mask = self.pruned_mask_by_cluster[cluster_name]
+            _, top_indices = torch.topk(cluster_importance_score.masked_fill(pruned_mask, float('inf')), \
+                                        active_num_redundant_groups, largest=False)
+            pruned_mask[top_indices] = True
+
+            # Route the selected global indexes back to the local indexes of their groups on device. Global indexes of
+            # a group are contiguous, hence sorting them lays out the picks group by group.
+            param_group_cluster = self.prunable_param_group_clusters[cluster_name]
+            top_indices, _ = torch.sort(top_indices)
+            self.gidx_to_group_by_cluster[cluster_name] = self.gidx_to_group_by_cluster[cluster_name].to(top_indices.device)
+            self.gidx_to_local_by_cluster[cluster_name] = self.gidx_to_local_by_cluster[cluster_name].to(top_indices.device)
+            groups_of = self.gidx_to_group_by_cluster[cluster_name].index_select(0, top_indices)
+            locals_of = self.gidx_to_local_by_cluster[cluster_name].index_select(0, top_indices)
+            counts = torch.bincount(groups_of, minlength=len(param_group_cluster))
+            # Fetch everything needed by the host-side bookkeeping with a single transfer
+            routing = torch.cat([locals_of, counts]).tolist()
+            num_top = locals_of.numel()
+            locals_list, counts_list = routing[:num_top], routing[num_top:]
+
+            offset = 0
+            for k, group in enumerate(param_group_cluster):
+                local_idxes = locals_of[offset:offset+counts_list[k]]
+                local_idxes_list = locals_list[offset:offset+counts_list[k]]
+                offset += counts_list[k]
                 if group['is_prunable'] and not group['is_auxiliary']:
-                    global_active_redundant_idx = np.intersect1d(top_indices, group['global_idxes'])
-                    self.active_redundant_idxes[group['id']] = (global_active_redundant_idx - group['global_start_idx']).tolist()
+                    self.active_redundant_idxes[group['id']] = local_idxes_list
                     # Refine important_idx by group_divisible
                     if group['num_groups'] < self.group_divisible:
                         self.active_redundant_idxes[group['id']] = list()
-                        self.pruned_idxes[group['id']] = list()
+                        self.pruned_masks[group['id']].zero_()
+                        self.pruned_idxes[group['id']] = self.pruned_idxes[group['id']][:0]
+                        self.expanded_pruned_idxes[group['id']] = dict()
                     else:
-                        curr_num_important_groups = len(self.important_idxes[group['id']])
-                        trial_num_important_groups = curr_num_important_groups - len(self.active_redundant_idxes[group['id']])
-                        if trial_num_important_groups % self.group_divisible != 0 or trial_num_important_groups <= 0:
-                            ratio = trial_num_important_groups // self.group_divisible + 1 # Add one will preserve more groups, otherwise will slim more.
-                            refined_num_important_groups = None
-                            if ratio <= 1 or trial_num_important_groups == 0:
-                                refined_num_important_groups = max(int(self.group_divisible), 1)
-                            else:
-                                refined_num_important_groups = max(int(ratio * self.group_divisible), int(self.group_divisible))   
-                            refined_num_important_groups = min(group['num_groups'], refined_num_important_groups)
-                            refined_num_active_redundant_groups = group['num_groups'] - len(self.pruned_idxes[group['id']]) - refined_num_important_groups
+                        # Redundant groups have been committed right before, hence all non-pruned groups are important
+                        curr_num_important_groups = group['num_groups'] - len(self.pruned_idxes[group['id']])
+                        refined_num_active_redundant_groups = refine_num_active_redundant_groups(group['num_groups'], self.group_divisible, \
+                            curr_num_important_groups, len(self.active_redundant_idxes[group['id']]), len(self.pruned_idxes[group['id']]))
+                        if refined_num_active_redundant_groups is not None:
                             self.target_num_redundant_groups += (refined_num_active_redundant_groups - len(self.active_redundant_idxes[group['id']]))
                             self.active_redundant_idxes[group['id']] = self.active_redundant_idxes[group['id']][:refined_num_active_redundant_groups]     
-                    self.important_idxes[group['id']] = [i for i in self.important_idxes[group['id']] if (i not in self.active_redundant_idxes[group['id']] and i not in self.pruned_idxes[group['id']])]
-                    group['active_redundant_bool'] = torch.zeros(group['num_groups'], dtype=torch.bool).cuda()
-                    group['active_redundant_bool'][self.active_redundant_idxes[group['id']]] = True                                                          
+                    local_idxes = local_idxes[:len(self.active_redundant_idxes[group['id']])]
+                    important_mask = self.important_masks[group['id']]
+                    torch.logical_not(self.pruned_masks[group['id']], out=important_mask)
+                    important_mask[local_idxes] = False
+                    group['active_redundant_idxes'] = local_idxes
+                    self.expanded_active_redundant_idxes[group['id']] = dict()
+                    for (_, _, _, _, p_transform, _) in self.lora_B_meta[group['id']]:
+                        if p_transform == TensorTransform.MULTIHEAD_HEADDIM:
+                            head_offsets = torch.arange(group['num_heads'], dtype=torch.long, device=local_idxes.device) * group['num_groups']
+                            expanded_idxes = (head_offsets.unsqueeze(1) + local_idxes.unsqueeze(0)).flatten()
+                        elif p_transform == TensorTransform.MULTIHEAD_NUMHEAD:
+                            dim_offsets = torch.arange(group['head_dim'], dtype=torch.long, device=local_idxes.device)
+                            expanded_idxes = (local_idxes.unsqueeze(1) * group['head_dim'] + dim_offsets.unsqueeze(0)).flatten()
+                        else:
+                            expanded_idxes = local_idxes
+                        self.expanded_active_redundant_idxes[group['id']][p_transform] = expanded_idxes
 
     def compute_grad_variant(self):
         for i, group in enumerate(self.param_groups):
@@ -255,27 +399,40 @@ class LHSPG(Optimizer):
             first_bias_correction = 1.0 - group['first_momentum'] ** self.num_steps if is_adam else None
             second_bias_correction = 1.0 - group['second_momentum'] ** self.num_steps if is_adam else None
             group['grad_variant'] = dict()
-            for j, (p_name, p) in enumerate(zip(group['p_names'], group['params'])):
-                if p.grad is None:
-                    continue
-                refined_grad_f = torch.clone(p.grad.data).detach()
-                if group['weight_decay'] is not None and group['variant'] != 'adamw':
-                    refined_grad_f += group['weight_decay'] * p.data
-                if not is_adam:
-                    if group['first_momentum'] > 0.0 or group['dampening'] > 0.0:
-                        refined_grad_f = self.get_first_momentum_grad(f"grad_first_moment_buffer_group_{i}_param_{j}", 
-                            group['first_momentum'], group['dampening'], refined_grad_f)
-                    group['grad_variant'][p_name] = refined_grad_f
-                else:
-                    first_moment_grad = self.get_first_momentum_grad(f"grad_first_moment_buffer_group_{i}_param_{j}", 
-                        group['first_momentum'], group['first_momentum'], refined_grad_f) 
-                    second_moment_grad_sq = self.get_second_momentum_grad_square(f"grad_second_moment_buffer_group_{i}_param_{j}", 
-                        group['second_momentum'], group['second_momentum'], refined_grad_f)
-
-                    exp_avg_first_moment_grad = first_moment_grad / first_bias_correction
-                    exp_avg_second_moment_grad_sq = second_moment_grad_sq / second_bias_correction
-                    denom = exp_avg_second_moment_grad_sq.sqrt().add_(self.safe_guard)
-                    group['grad_variant'][p_name] = exp_avg_first_moment_grad / denom
+            # Hyper-parameters are shared within a param group, hence batch all its params into foreach kernels
+            p_idxes = [j for j, p in enumerate(group['params']) if p.grad is not None]
+            if len(p_idxes) == 0:
+                continue
+            p_names = [group['p_names'][j] for j in p_idxes]
+            params = [group['params'][j].data for j in p_idxes]
+            # Gradients only need a private copy if they are modified in place or kept as momentum buffers
+            apply_weight_decay = group['weight_decay'] is not None and group['weight_decay'] != 0.0 and group['variant'] != 'adamw'
+            needs_copy = apply_weight_decay or is_adam or group['first_momentum'] > 0.0
+            if needs_copy:
+                refined_grads_f = [torch.clone(group['params'][j].grad.data).detach() for j in p_idxes]
+            else:
+                refined_grads_f = [group['params'][j].grad.data.detach() for j in p_idxes]
+            if apply_weight_decay:
+                torch._foreach_add_(refined_grads_f, params, alpha=group['weight_decay'])
+            if not is_adam:
+                if group['first_momentum'] > 0.0 or group['dampening'] > 0.0:
+                    refined_grads_f = self.get_first_momentum_grad(i, p_idxes, 
+                        group['first_momentum'], group['dampening'], refined_grads_f)
+                group['grad_variant'].update(zip(p_names, refined_grads_f))
+            else:
+                first_moment_grads = self.get_first_momentum_grad(i, p_idxes, 
+                    group['first_momentum'], group['first_momentum'], refined_grads_f) 
+                second_moment_grads_sq = self.get_second_momentum_grad_square(i, p_idxes, 
+                    group['second_momentum'], group['second_momentum'], refined_grads_f)
+
+                # Compute everything in place within the single output allocated per param
+                grad_variants = torch._foreach_mul(second_moment_grads_sq, 1.0 / second_bias_correction)
+                torch._foreach_sqrt_(grad_variants)
+                torch._foreach_add_(grad_variants, self.safe_guard)
+                torch._foreach_reciprocal_(grad_variants)
+                torch._foreach_mul_(grad_variants, first_moment_grads)
+                torch._foreach_div_(grad_variants, first_bias_correction)
+                group['grad_variant'].update(zip(p_names, grad_variants))
 
     def reach_target_group_sparsity(self):
         if self.curr_num_zero_groups < self.target_num_redundant_groups:
@@ -286,10 +443,27 @@ class LHSPG(Optimizer):
     def commit_redundant_idxes(self):
         for group in self.param_groups:
             if group['is_prunable'] and not group['is_auxiliary']:
-                self.pruned_idxes[group['id']].extend(self.active_redundant_idxes[group['id']])
+                pruned_mask = self.pruned_masks[group['id']]
+                pruned_mask[self.active_redundant_idxes[group['id']]] = True
+                self.pruned_idxes[group['id']] = pruned_mask.nonzero(as_tuple=True)[0]
+                torch.logical_not(pruned_mask, out=self.important_masks[group['id']])
                 self.active_redundant_idxes[group['id']] = list()
-                self.important_idxes[group['id']] = [i for i in range(group['num_groups']) if i not in self.pruned_idxes[group['id']]]
+                self.expanded_pruned_idxes[group['id']] = dict()
                 group['importance_scores'] = dict()
+        self.sparsity_dirty = True
+
+    def get_expanded_pruned_idxes(self, group, p_transform, device):
+        cache = self.expanded_pruned_idxes[group['id']]
+        if p_transform not in cache:
+            pruned_idxes = self.pruned_idxes[group['id']].to(device)
+            if p_transform == TensorTransform.MULTIHEAD_HEADDIM:
+                head_offsets = torch.arange(group['num_heads'], dtype=torch.long, device=device) * group['head_dim']
+                pruned_idxes = (head_offsets.unsqueeze(1) + pruned_idxes.unsqueeze(0)).flatten()
+            elif p_transform == TensorTransform.MULTIHEAD_NUMHEAD:
+                dim_offsets = torch.arange(group['head_dim'], dtype=torch.long, device=device)
+                pruned_idxes = (pruned_idxes.unsqueeze(1) * group['head_dim'] + dim_offsets.unsqueeze(0)).flatten()
+            cache[p_transform] = pruned_idxes
+        return cache[p_transform]
 
     def step(self):
         self.num_steps += 1
@@ -305,120 +479,92 @@ class LHSPG(Optimizer):
                 self.compute_importance_scores()
                 self.identify_redundant_groups()
                 self.curr_pruning_period += 1
+                self.sparsity_dirty = True
 
         # Second pass to update variables    
         t = (self.num_steps - self.start_pruning_step) % self.pruning_period_duration
+        decay_scale = (self.pruning_period_duration - t - 1.0) / (self.pruning_period_duration - t)
         for i, group in enumerate(self.param_groups):
+            decoupled_weight_decay = group['weight_decay'] if group['weight_decay'] is not None and group['variant'] == 'adamw' else None
             if not group['is_prunable'] or len(self.active_redundant_idxes[group['id']]) == 0:
-                for p_name, p in zip(group['p_names'], group['params']):
-                    if p_name not in group['grad_variant']:
-                        continue
-                    if group['weight_decay'] is not None and group['variant'] == 'adamw':
-                        p.data.add_(group['weight_decay'] * p.data, alpha=-group['lr'])
-                    p.data.add_(group['grad_variant'][p_name], alpha=-group['lr'])
+                p_names = [p_name for p_name in group['p_names'] if p_name in group['grad_variant']]
+                params = [p.data for p_name, p in zip(group['p_names'], group['params']) if p_name in group['grad_variant']]
+                gradient_descent_step_(params, [group['grad_variant'][p_name] for p_name in p_names], group['lr'], decoupled_weight_decay)
             elif group['is_prunable'] and len(self.active_redundant_idxes[group['id']]) > 0:
-                for (p_name, p, p_transform) in zip(group['p_names'], group['params'], group['p_transform']):
-                    # if p_name not in group['grad_variant']:
-                    #     continue
-                    if 'lora_B' in p_name:
-                        if group['weight_decay'] is not None and group['variant'] == 'adamw':
-                            p.data.add_(group['weight_decay'] * p.data, alpha=-group['lr'])
-                        p.data.add_(group['grad_variant'][p_name], alpha=-group['lr'])
-                        original_weight_name = p_name.split('lora_B')[0] + 'weight'
-                        original_bias_name = p_name.split('lora_B')[0] + 'bias'
-                        original_weight = self.named_parameters[original_weight_name]
-                        original_bias = None if original_bias_name not in self.named_parameters else self.named_parameters[original_bias_name]
-                        active_redundant_bool = None
-                        if p_transform == TensorTransform.MULTIHEAD_HEADDIM:
-                            active_redundant_bool = tensor_transformation(group['active_redundant_bool'], TensorTransform.REVERSE_MULTIHEAD_HEADDIM, \
-                                                                          num_groups=group['num_groups'], num_heads=group['num_heads'])
-                        elif p_transform == TensorTransform.MULTIHEAD_NUMHEAD:
-                            active_redundant_bool = tensor_transformation(group['active_redundant_bool'], TensorTransform.REVERSE_MULTIHEAD_NUMHEAD, \
-                                                                          num_groups=group['num_groups'], head_dim=group['head_dim'])
-                        else:
-                            active_redundant_bool = group['active_redundant_bool']
-                        p.data[active_redundant_bool] *= (self.pruning_period_duration - t - 1.0) / (self.pruning_period_duration - t)
-                        original_weight.data[active_redundant_bool] *= (self.pruning_period_duration - t - 1.0) / (self.pruning_period_duration - t)
-                        if original_bias is not None:
-                            original_bias.data[active_redundant_bool] *= (self.pruning_period_duration - t - 1.0) / (self.pruning_period_duration - t)
-                    if 'lora_embedding_B' in p_name:
-                        if group['weight_decay'] is not None and group['variant'] == 'adamw':
-                            p.data.add_(group['weight_decay'] * p.data, alpha=-group['lr'])
-                        p.data.add_(group['grad_variant'][p_name], alpha=-group['lr'])
-                        for (decay_p_name, decay_param, decay_p_transform) in zip(group['p_names'], group['params'], group['p_transform']):    
-                            if decay_p_transform == TensorTransform.BASIC:
-                                decay_param.data[group['active_redundant_bool']] *= (self.pruning_period_duration - t - 1.0) / (self.pruning_period_duration - t)
-                            elif decay_p_transform == TensorTransform.TRANSPOSE:
-                                decay_param.data[:, group['active_redundant_bool']] *= (self.pruning_period_duration - t - 1.0) / (self.pruning_period_duration - t)
-                            # print(decay_p_name, decay_param.shape, decay_p_transform)
-                        break
+                lora_B_meta = self.lora_B_meta[group['id']]
+                gradient_descent_step_([p.data for (_, p, _, _, _, _) in lora_B_meta], \
+                                       [group['grad_variant'][p_name] for (p_name, _, _, _, _, _) in lora_B_meta], group['lr'], decoupled_weight_decay)
+                for (p_name, p, original_weight, original_bias, p_transform, _) in lora_B_meta:
+                    decay_triplet_(p.data, original_weight.data, None if original_bias is None else original_bias.data, \
+                                   self.expanded_active_redundant_idxes[group['id']][p_transform], decay_scale)
+                # Only the first lora_embedding_B drives the decay of the whole group
+                for (p_name, p, _) in self.lora_embedding_B_meta[group['id']][:1]:
+                    gradient_descent_step_([p.data], [group['grad_variant'][p_name]], group['lr'], decoupled_weight_decay)
+                    for (decay_param, dim) in self.decay_params[group['id']]:
+                        scale_selected_slices_(decay_param.data, group['active_redundant_idxes'], decay_scale, dim)
                         
             if len(self.pruned_idxes[group['id']]) > 0:
-                for p_name, p, p_transform in zip(group['p_names'], group['params'], group['p_transform']):
-                    if 'lora_B' in p_name:
-                        original_weight_name = p_name.split('lora_B')[0] + 'weight'
-                        original_bias_name = p_name.split('lora_B')[0] + 'bias'
-                        original_weight = self.named_parameters[original_weight_name]
-                        original_bias = None if original_bias_name not in self.named_parameters else self.named_parameters[original_bias_name]
-                        if p_transform == TensorTransform.MULTIHEAD_HEADDIM:
-                            pruned_idxes = list()
-                            for h in range(group['num_heads']):
-                                pruned_idxes.extend([i + h * group['head_dim'] for i in self.pruned_idxes[group['id']]])
-                            p.data[pruned_idxes] = 0.0
-                            original_weight.data[pruned_idxes] = 0.0
-                            if original_bias is not None:
-                                original_bias.data[pruned_idxes] = 0.0
-                        elif p_transform == TensorTransform.MULTIHEAD_NUMHEAD:
-                            pruned_idxes = list()
-                            for i in self.pruned_idxes[group['id']]:
-                                pruned_idxes.extend([h + i * group['head_dim'] for h in range(group['head_dim'])])                            
-                            p.data[pruned_idxes] = 0.0
-                            original_weight.data[pruned_idxes] = 0.0
-                            if original_bias is not None:
-                                original_bias.data[pruned_idxes] = 0.0
-                        elif p_transform == TensorTransform.TRANSPOSE and len(p.data.shape) > 1:
-                            p.data[:, self.pruned_idxes[group['id']]] = 0.0
-                            original_weight.data[self.pruned_idxes[group['id']]] = 0.0
-                        else:
-                            p.data[self.pruned_idxes[group['id']]] = 0.0
-                            original_weight.data[self.pruned_idxes[group['id']]] = 0.0
-                            if original_bias is not None:
-                                original_bias.data[self.pruned_idxes[group['id']]] = 0.0
-
-                    if 'lora_embedding_B' in p_name:
-                        original_weight_name = p_name.split('lora_embedding_B')[0] + 'weight'
-                        original_weight = self.named_parameters[original_weight_name]
-                        p.data[self.pruned_idxes[group['id']]] = 0.0
-                        original_weight.data[:, self.pruned_idxes[group['id']]] = 0.0
+                for (p_name, p, original_weight, original_bias, p_transform, is_transpose) in self.lora_B_meta[group['id']]:
+                    pruned_idxes = self.get_expanded_pruned_idxes(group, p_transform, p.device)
+                    if is_transpose:
+                        p.data[:, pruned_idxes] = 0.0
+                        original_weight.data[pruned_idxes] = 0.0
+                    else:
+                        p.data[pruned_idxes] = 0.0
+                        original_weight.data[pruned_idxes] = 0.0
+                        if original_bias is not None:
+                            original_bias.data[pruned_idxes] = 0.0
+                for (p_name, p, original_weight) in self.lora_embedding_B_meta[group['id']]:
+                    pruned_idxes = self.get_expanded_pruned_idxes(group, TensorTransform.BASIC, p.device)
+                    p.data[pruned_idxes] = 0.0
+                    original_weight.data[:, pruned_idxes] = 0.0
 
         if self.num_steps >= self.start_pruning_step and t == self.pruning_period_duration - 1:
             self.commit_redundant_idxes()
 
-        self.curr_group_sparsity, _, self.curr_num_zero_groups = self.compute_group_sparsity_param_norm()
+        # Number of zero groups only changes once redundant groups are identified or committed
+        if self.sparsity_dirty:
+            self.curr_group_sparsity, _, self.curr_num_zero_groups = self.compute_group_sparsity_param_norm()
+            self.sparsity_dirty = False
         return 
 
+    def compute_norm_group(self, group):
+        norm_group = None
+        for p_name, param, p_transform in zip(group['p_names'], group['params'], group['p_transform']):
+            if p_transform == TensorTransform.NO_PRUNE:
+                continue
+            param_transform = None
+            if p_transform == TensorTransform.MULTIHEAD_HEADDIM:
+                param_transform = tensor_transformation(param, p_transform, group['num_groups'], group['num_heads'])
+            else:
+                param_transform = tensor_transformation(param, p_transform, group['num_groups'])
+            # Accumulate squared row norms in place, avoiding both a squared copy of the param and a stacked temporary
+            if norm_group is None:
+                norm_group = torch.linalg.vector_norm(param_transform, dim=1).square_()
+            else:
+                norm_group += torch.linalg.vector_norm(param_transform, dim=1).square_()
+        if norm_group is None:
+            return None
+        return norm_group.sqrt_()
+
     def compute_group_sparsity_param_norm(self):
-        total_num_zero_groups = 0
-        norm_x = 0.0
+        # Accumulate on device in float64 and synchronize with host once rather than once per group
+        zero_counter = None
+        norm_x_t = None
         for group in self.param_groups:
             if group['is_prunable'] and not group['is_auxiliary']:
-                norm_group = None
-                for p_name, param, p_transform in zip(group['p_names'], group['params'], group['p_transform']):
-                    if p_transform == TensorTransform.NO_PRUNE:
-                        continue
-                    param_transform = None
-                    if p_transform == TensorTransform.MULTIHEAD_HEADDIM:
-                        param_transform = tensor_transformation(param, p_transform, group['num_groups'], group['num_heads'])
-                    else:
-                        param_transform = tensor_transformation(param, p_transform, group['num_groups'])
-                    if norm_group == None:
-                        norm_group = torch.norm(param_transform, dim=1) ** 2
-                    else:
-                        norm_group += torch.norm(param_transform, dim=1) ** 2
-                norm_group = torch.sqrt(norm_group)
-                num_zero_groups = torch.sum(norm_group == 0).item()
-                total_num_zero_groups += num_zero_groups
-                norm_x += torch.sum(norm_group).item()
+                norm_group = self.compute_norm_group(group)
+                if norm_group is None:
+                    continue
+                if zero_counter is None:
+                    zero_counter = torch.zeros((), dtype=torch.long, device=norm_group.device)
+                    norm_x_t = torch.zeros((), dtype=torch.float64, device=norm_group.device)
+                zero_counter += (norm_group == 0).sum()
+                norm_x_t += norm_group.sum(dtype=torch.float64)
+        if zero_counter is None:
+            return 0.0, 0.0, 0
+        total_num_zero_groups, norm_x = torch.stack([zero_counter.double(), norm_x_t]).tolist()
+        total_num_zero_groups = int(total_num_zero_groups)
         group_sparsity = total_num_zero_groups / float(self.total_num_groups + self.safe_guard)
         return group_sparsity, norm_x, total_num_zero_groups
         
@@ -428,30 +574,32 @@ class LHSPG(Optimizer):
         self.num_important_groups = 0
         self.num_redundant_groups = 0
         
+        norm_important_groups_t = None
+        norm_redundant_groups_t = None
+        num_important_groups_t = None
         for group in self.param_groups:
             if group['is_prunable'] and not group['is_auxiliary']:
                 id = group['id']
-                import_idxes = self.important_idxes[id]
-                redund_idxes = self.pruned_idxes[id] + self.active_redundant_idxes[id]
-                norm_group = None
-                for p_name, param, p_transform in zip(group['p_names'], group['params'], group['p_transform']):
-                    if p_transform == TensorTransform.NO_PRUNE:
-                        continue
-                    param_transform = None
-                    if p_transform == TensorTransform.MULTIHEAD_HEADDIM:
-                        param_transform = tensor_transformation(param, p_transform, group['num_groups'], group['num_heads'])
-                    else:
-                        param_transform = tensor_transformation(param, p_transform, group['num_groups'])
-                    if norm_group == None:
-                        norm_group = torch.norm(param_transform, dim=1) ** 2
-                    else:
-                        norm_group += torch.norm(param_transform, dim=1) ** 2
-                norm_group = torch.sqrt(norm_group)
-                self.norm_important_groups += torch.sum(norm_group[import_idxes]).item()
-                self.norm_redundant_groups += torch.sum(norm_group[redund_idxes]).item()
-                self.num_important_groups += len(import_idxes)
+                important_mask = self.important_masks[id]
+                redund_idxes = torch.cat([self.pruned_idxes[id], torch.as_tensor(self.active_redundant_idxes[id], dtype=torch.long, \
+                                                                                 device=self.pruned_idxes[id].device)])
+                norm_group = self.compute_norm_group(group)
+                if norm_group is None:
+                    continue
+                if norm_important_groups_t is None:
+                    norm_important_groups_t = torch.zeros((), dtype=torch.float64, device=norm_group.device)
+                    norm_redundant_groups_t = torch.zeros((), dtype=torch.float64, device=norm_group.device)
+                    num_important_groups_t = torch.zeros((), dtype=torch.long, device=norm_group.device)
+                # Multiply by the mask rather than boolean indexing, which would synchronize with host
+                norm_important_groups_t += torch.sum(norm_group * important_mask, dtype=torch.float64)
+                norm_redundant_groups_t += torch.sum(norm_group[redund_idxes], dtype=torch.float64)
+                num_important_groups_t += important_mask.sum()
                 self.num_redundant_groups += len(redund_idxes)
 
+        if norm_important_groups_t is not None:
+            self.norm_important_groups, self.norm_redundant_groups, num_important_groups = torch.stack([norm_important_groups_t, \
+                norm_redundant_groups_t, num_important_groups_t.double()]).tolist()
+            self.num_important_groups = int(num_important_groups)
         return self.norm_important_groups, self.norm_redundant_groups, self.num_important_groups, self.num_redundant_groups  
                   
     def set_learning_rate(self, lr):